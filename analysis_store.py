@@ -0,0 +1,206 @@
+# analysis_store.py
+"""
+Persistent SQLite store of image analyses for main.py.
+
+Each row keeps the Gemini report, the parsed abnormalities, the SHA-256 of the uploaded
+image and a small PNG thumbnail, so past studies can be reopened without calling the model
+again. Lookups go through indexes on image hash, patient ID, study ID, timestamp and highest
+severity, and listing uses keyset pagination on the row id instead of OFFSET, so reads stay
+fast as the table grows.
+"""
+import hashlib
+import json
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+SEVERITY_RANKS = {"Low": 1, "Medium": 2, "High": 3}
+
+# created_at is stored in UTC in this fixed-width format so string order matches time order
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    image_hash TEXT NOT NULL,
+    patient_id TEXT,
+    study_id TEXT,
+    filename TEXT,
+    detection_mode TEXT,
+    created_at TEXT NOT NULL,
+    max_severity INTEGER NOT NULL DEFAULT 0,
+    abnormalities_count INTEGER NOT NULL DEFAULT 0,
+    report TEXT,
+    abnormalities TEXT,
+    thumbnail BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_image_hash ON analyses (image_hash, id);
+CREATE INDEX IF NOT EXISTS idx_analyses_patient ON analyses (patient_id, id);
+CREATE INDEX IF NOT EXISTS idx_analyses_study ON analyses (study_id, id);
+CREATE INDEX IF NOT EXISTS idx_analyses_created_at ON analyses (created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_severity ON analyses (max_severity, id);
+"""
+
+# Columns returned by list queries; the full report and thumbnail are only loaded by get()
+SUMMARY_COLUMNS = "id, image_hash, patient_id, study_id, filename, detection_mode, created_at, max_severity, abnormalities_count"
+
+
+def image_hash(content: bytes) -> str:
+    """SHA-256 hex digest of the uploaded image bytes."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def _normalize_timestamp(value: str, name: str) -> str:
+    """Parse an ISO 8601 timestamp (naive means UTC) into the stored created_at format."""
+    value = value.strip()
+    if value[-1:] in ("Z", "z"):
+        value = value[:-1] + "+00:00"  # fromisoformat only accepts a trailing "Z" from Python 3.11
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 timestamp, e.g. 2024-01-31T12:00:00Z")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def _severity_name(rank: int) -> Optional[str]:
+    for name, value in SEVERITY_RANKS.items():
+        if value == rank:
+            return name
+    return None
+
+
+def _row_to_dict(row: sqlite3.Row) -> dict:
+    record = {key: row[key] for key in row.keys() if key != "thumbnail"}
+    record["max_severity"] = _severity_name(record["max_severity"])
+    if record.get("abnormalities") is not None:
+        record["abnormalities"] = json.loads(record["abnormalities"])
+    return record
+
+
+class AnalysisStore:
+    """Small wrapper around a SQLite database file; safe to share between threads."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # A connection per operation keeps this usable from the event loop and worker threads alike
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def save(self, image_hash: str, report: Optional[str], abnormalities_data: Optional[dict],
+             thumbnail: Optional[bytes] = None, patient_id: Optional[str] = None, study_id: Optional[str] = None,
+             filename: Optional[str] = None, detection_mode: Optional[str] = None) -> int:
+        """Store one analysis and return its id."""
+        abnormalities = (abnormalities_data or {}).get("abnormalities", [])
+        max_severity = max((SEVERITY_RANKS.get(a.get("severity"), 0) for a in abnormalities), default=0)
+
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO analyses (image_hash, patient_id, study_id, filename, detection_mode, created_at, "
+                "max_severity, abnormalities_count, report, abnormalities, thumbnail) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    image_hash, patient_id, study_id, filename, detection_mode,
+                    datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT),
+                    max_severity, len(abnormalities), report,
+                    json.dumps(abnormalities_data) if abnormalities_data is not None else None,
+                    thumbnail,
+                )
+            )
+            return cursor.lastrowid
+
+    def get(self, analysis_id: int) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+        return _row_to_dict(row) if row else None
+
+    def latest_by_hash(self, image_hash: str, detection_mode: Optional[str] = None,
+                       require_abnormalities: bool = False) -> Optional[dict]:
+        """Most recent analysis of an image, optionally limited to one detection mode."""
+        query = "SELECT * FROM analyses WHERE image_hash = ? AND report IS NOT NULL"
+        params = [image_hash]
+        if detection_mode is not None:
+            query += " AND detection_mode = ?"
+            params.append(detection_mode)
+        if require_abnormalities:
+            query += " AND abnormalities IS NOT NULL"
+
+        with self._connect() as conn:
+            row = conn.execute(query + " ORDER BY id DESC LIMIT 1", params).fetchone()
+        return _row_to_dict(row) if row else None
+
+    def thumbnail(self, analysis_id: int) -> Optional[bytes]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT thumbnail FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+        return row["thumbnail"] if row else None
+
+    def list(self, patient_id: Optional[str] = None, study_id: Optional[str] = None, min_severity: Optional[str] = None,
+             since: Optional[str] = None, until: Optional[str] = None, limit: int = 20,
+             cursor: Optional[int] = None) -> dict:
+        """
+        Newest-first page of analysis summaries matching the filters.
+
+        Pass the returned next_cursor back as cursor to fetch the following page.
+        """
+        clauses = []
+        params = []
+        ranks = None
+        if patient_id is not None:
+            clauses.append("patient_id = ?")
+            params.append(patient_id)
+        if study_id is not None:
+            clauses.append("study_id = ?")
+            params.append(study_id)
+        if min_severity is not None:
+            if min_severity not in SEVERITY_RANKS:
+                raise ValueError(f"min_severity must be one of: {', '.join(SEVERITY_RANKS)}")
+            ranks = [rank for rank in SEVERITY_RANKS.values() if rank >= SEVERITY_RANKS[min_severity]]
+        # Rows are inserted in time order, so timestamp bounds become id bounds found via the created_at index
+        if since is not None:
+            clauses.append("id >= (SELECT id FROM analyses WHERE created_at >= ? ORDER BY created_at LIMIT 1)")
+            params.append(_normalize_timestamp(since, "since"))
+        if until is not None:
+            clauses.append(
+                "id < COALESCE((SELECT id FROM analyses WHERE created_at >= ? ORDER BY created_at LIMIT 1), "
+                "9223372036854775807)"
+            )
+            params.append(_normalize_timestamp(until, "until"))
+        if cursor is not None:
+            clauses.append("id < ?")
+            params.append(cursor)
+
+        def page_query(extra_clauses, extra_params):
+            all_clauses = clauses + extra_clauses
+            query = f"SELECT {SUMMARY_COLUMNS} FROM analyses"
+            if all_clauses:
+                query += " WHERE " + " AND ".join(all_clauses)
+            # One extra row tells us whether another page exists
+            return query + " ORDER BY id DESC LIMIT ?", params + extra_params + [limit + 1]
+
+        with self._connect() as conn:
+            if ranks is None:
+                rows = conn.execute(*page_query([], [])).fetchall()
+            else:
+                # Neither a range nor an IN list on max_severity can walk the (max_severity, id)
+                # index in id order, so seek it once per rank and merge the pages here
+                rows = []
+                for rank in ranks:
+                    rows.extend(conn.execute(*page_query(["max_severity = ?"], [rank])).fetchall())
+                rows = sorted(rows, key=lambda row: row["id"], reverse=True)[:limit + 1]
+
+        items = [_row_to_dict(row) for row in rows[:limit]]
+        has_more = len(rows) > limit
+        return {"items": items, "next_cursor": items[-1]["id"] if has_more and items else None}
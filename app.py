@@ -1,9 +1,11 @@
 # app.py
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
 import joblib
+import math
 import numpy as np
 import os
+import profiling
 
 app = Flask(__name__)
 
@@ -22,6 +24,18 @@ if os.environ.get("FRONTEND_URL"):
 
 CORS(app, origins=allowed_origins)
 
+# Opt-in profiling, toggled at runtime via /admin/profiling or SIGUSR2
+profiler = profiling.Profiler("app")
+profiling.install_signal_toggle(profiler)
+
+@app.before_request
+def start_profiling():
+    g.profile_trace = profiler.begin_request(f"{request.method} {request.path}")
+
+@app.teardown_request
+def stop_profiling(exc):
+    profiler.end_request(g.pop("profile_trace", None))
+
 # Load diabetes artifacts
 DIABETES_MODEL_PATH = "diabetes_model.pkl"
 DIABETES_SCALER_PATH = "diabetes_scaler.pkl"
@@ -56,6 +70,22 @@ PCOS_FIELDS = [
     "Age", "BMI", "Menstrual_Irregularity", "Testosterone_Level_ng_dL", "Antral_Follicle_Count"
 ]
 
+# Model registry used by /predict/all
+DISEASE_MODELS = {
+    "diabetes": {"fields": DIABETES_FIELDS, "model": diabetes_model, "scaler": diabetes_scaler},
+    "heart": {"fields": HEART_FIELDS, "model": heart_model, "scaler": None},
+    "pcos": {"fields": PCOS_FIELDS, "model": pcos_model, "scaler": pcos_scaler},
+}
+
+def specific_fields(model_name):
+    """Fields only this model uses; a record that has one of them is scored by that model."""
+    other_fields = {f for other, spec in DISEASE_MODELS.items() if other != model_name for f in spec["fields"]}
+    return [f for f in DISEASE_MODELS[model_name]["fields"] if f not in other_fields]
+
+SPECIFIC_FIELDS = {name: specific_fields(name) for name in DISEASE_MODELS}
+
+MAX_BATCH_SIZE = 500
+
 @app.route("/health", methods=["GET"])
 def health():
     return {"status": "ok", "diabetes_model": DIABETES_MODEL_PATH, "heart_model": HEART_MODEL_PATH, "pcos_model": PCOS_MODEL_PATH}, 200
@@ -106,6 +136,110 @@ def predict_pcos():
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
+@app.route("/admin/profiling", methods=["GET", "POST"])
+def admin_profiling():
+    if not profiling.is_authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "Unauthorized"}), 403
+    
+    if request.method == "GET":
+        return jsonify(profiler.status())
+    
+    try:
+        data = request.get_json(force=True)
+        return jsonify(profiler.configure(**profiling.parse_settings(data)))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/admin/profiling/cpu", methods=["GET"])
+def admin_profiling_cpu():
+    if not profiling.is_authorized(request.headers.get("X-Admin-Token")):
+        return jsonify({"error": "Unauthorized"}), 403
+    
+    try:
+        seconds = min(float(request.args.get("seconds", 5)), 60)
+        return jsonify(profiler.sample_cpu(seconds))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/predict/all", methods=["POST"])
+def predict_all():
+    """
+    Score one patient record, or a batch under "patients", with every applicable model.
+    
+    A model applies when the record has at least one field only that model uses, unless
+    "models" lists the models to run explicitly. Each record is parsed once over the fields
+    of its selected models, so shared fields like Age and BMI are converted a single time,
+    and each model runs a single vectorized prediction over all records it applies to.
+    """
+    try:
+        data = request.get_json(force=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Expected a JSON object"}), 400
+        
+        is_batch = "patients" in data
+        records = data["patients"] if is_batch else [data]
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            return jsonify({"error": "patients must be a list of objects"}), 400
+        if len(records) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"At most {MAX_BATCH_SIZE} patients per request"}), 400
+        
+        requested = data.get("models")
+        if requested is not None:
+            if not isinstance(requested, list) or not all(isinstance(m, str) for m in requested):
+                return jsonify({"error": "models must be a list of model names"}), 400
+            unknown = [m for m in requested if m not in DISEASE_MODELS]
+            if unknown:
+                return jsonify({"error": f"Unknown models: {', '.join(unknown)}. Use: {', '.join(DISEASE_MODELS)}"}), 400
+        
+        # Parse every record once into floats for the union of its selected models' fields
+        results = []
+        parsed = []
+        for record in records:
+            models = requested if requested is not None else [
+                name for name in DISEASE_MODELS
+                if any(f in record for f in SPECIFIC_FIELDS[name])
+            ]
+            record_fields = dict.fromkeys(f for name in models for f in DISEASE_MODELS[name]["fields"])
+            try:
+                values = {f: float(record.get(f, 0)) for f in record_fields}
+            except (TypeError, ValueError) as e:
+                results.append({"error": str(e)})
+                parsed.append(None)
+                continue
+            non_finite = [f for f, value in values.items() if not math.isfinite(value)]
+            if non_finite:
+                # float() accepts "nan"/"inf" and JSON 1e400 overflows to inf; neither is a valid measurement
+                results.append({"error": f"Values must be finite numbers: {', '.join(non_finite)}"})
+                parsed.append(None)
+                continue
+            
+            results.append({"predictions": {}, "skipped": [m for m in DISEASE_MODELS if m not in models]})
+            parsed.append((values, models))
+        
+        # One predict/predict_proba call per model across all records it applies to
+        for name, spec in DISEASE_MODELS.items():
+            rows = [i for i, p in enumerate(parsed) if p is not None and name in p[1]]
+            if not rows:
+                continue
+            
+            X = np.array([[parsed[i][0][f] for f in spec["fields"]] for i in rows])
+            if spec["scaler"] is not None:
+                X = spec["scaler"].transform(X)
+            preds = spec["model"].predict(X)
+            probas = spec["model"].predict_proba(X)[:, 1]
+            
+            for i, pred, proba in zip(rows, preds, probas):
+                results[i]["predictions"][name] = {"prediction": int(pred), "probability": float(proba)}
+        
+        fields = {name: spec["fields"] for name, spec in DISEASE_MODELS.items()}
+        if is_batch:
+            return jsonify({"results": results, "fields": fields})
+        if "error" in results[0]:
+            return jsonify(results[0]), 400
+        return jsonify({**results[0], "fields": fields})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 5001))
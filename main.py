@@ -1,10 +1,18 @@
 import os
+import asyncio
 import tempfile
+import threading
+import hashlib
+import hmac
+import math
+import shutil
+import time
+from xml.sax.saxutils import escape, quoteattr
 from typing import Optional, List, Tuple
 from PIL import Image as PILImage, ImageDraw, ImageFont
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 import uvicorn
 import base64
 import io
@@ -15,6 +23,9 @@ import cv2
 import numpy as np
 import json
 import re
+import profiling
+from resilience import CircuitBreaker, HedgedCaller, ServiceUnavailableError
+from analysis_store import AnalysisStore, image_hash
 
 # Set your API Key (Replace with your actual key)
 load_dotenv()
@@ -40,9 +51,107 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in profiling, toggled at runtime via /admin/profiling or SIGUSR2
+profiler = profiling.Profiler("main")
+profiling.install_signal_toggle(profiler)
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    # Async handlers share the event loop thread, so slow request stack samples
+    # also include whatever other requests were running on the loop at the time
+    name = f"{request.method} {request.url.path}"
+    if profiler.takes_snapshots:
+        # tracemalloc snapshots are slow, take them off the event loop
+        trace = await asyncio.to_thread(profiler.begin_request, name, threading.get_ident())
+    else:
+        trace = profiler.begin_request(name)
+    try:
+        return await call_next(request)
+    finally:
+        if trace is not None and trace.snapshot is not None:
+            await asyncio.to_thread(profiler.end_request, trace)
+        else:
+            profiler.end_request(trace)
+
 # Initialize the Gemini model
 model = genai.GenerativeModel('gemini-1.5-flash')
 
+# Tail-latency controls for Gemini: overall timeout, hedged duplicate requests and a circuit breaker
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))  # Seconds before a call is abandoned
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "16"))  # Threads per caller for in-flight Gemini calls
+
+# One breaker for the upstream as a whole, so errors from any prompt type open it
+gemini_breaker = CircuitBreaker(
+    "gemini",
+    window=int(os.getenv("GEMINI_BREAKER_WINDOW", "20")),
+    min_calls=int(os.getenv("GEMINI_BREAKER_MIN_CALLS", "5")),
+    error_rate=float(os.getenv("GEMINI_BREAKER_ERROR_RATE", "0.5")),
+    slow_call_seconds=float(os.getenv("GEMINI_BREAKER_SLOW_CALL_SECONDS", "30")),
+    slow_call_rate=float(os.getenv("GEMINI_BREAKER_SLOW_CALL_RATE", "0.5")),
+    cooldown=float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+)
+
+# A caller per prompt type, since long-form reports and short JSON annotations have very
+# different latencies; a shared history would get nearly every report call hedged
+gemini_callers = {
+    prompt_type: HedgedCaller(
+        f"Gemini ({prompt_type})",
+        gemini_breaker,
+        timeout=GEMINI_TIMEOUT,
+        hedge_percentile=float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95")),
+        default_hedge_delay=float(os.getenv(f"GEMINI_HEDGE_DELAY_{prompt_type.upper()}", default_delay)),
+        max_workers=GEMINI_MAX_WORKERS
+    )
+    for prompt_type, default_delay in [("report", "20"), ("annotation", "10")]
+}
+
+def generate_content(contents, prompt_type: str):
+    """Call Gemini through the hedging/circuit breaker wrapper for the given prompt type."""
+    return gemini_callers[prompt_type].call(
+        model.generate_content, contents, request_options={"timeout": GEMINI_TIMEOUT}
+    )
+
+@app.exception_handler(ServiceUnavailableError)
+async def service_unavailable_handler(request: Request, exc: ServiceUnavailableError):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    return JSONResponse(status_code=exc.status_code, content={"detail": str(exc)}, headers=headers)
+
+# Tiled analysis settings for large radiographs
+TILE_SIZE = int(os.getenv("TILE_SIZE", "1024"))  # Tile edge length in pixels
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", "128"))  # Overlap between neighbouring tiles in pixels
+TILE_MAX_CONCURRENCY = int(os.getenv("TILE_MAX_CONCURRENCY", "4"))  # Max Gemini calls in flight per image
+TILE_GLOBAL_CONCURRENCY = int(os.getenv("TILE_GLOBAL_CONCURRENCY", "8"))  # Max tile calls in flight across all requests
+MAX_TILES = int(os.getenv("MAX_TILES", "36"))  # Tiles grow beyond TILE_SIZE to keep an image under this count
+NMS_IOU_THRESHOLD = float(os.getenv("NMS_IOU_THRESHOLD", "0.3"))  # Overlap above which duplicate boxes are merged
+
+# Reject tiling settings that would explode into thousands of Gemini calls per image
+if TILE_SIZE < 1 or not 0 <= TILE_OVERLAP < TILE_SIZE:
+    raise ValueError("⚠️ TILE_OVERLAP must be at least 0 and smaller than TILE_SIZE")
+if TILE_MAX_CONCURRENCY < 1 or TILE_GLOBAL_CONCURRENCY < 1 or MAX_TILES < 1:
+    raise ValueError("⚠️ TILE_MAX_CONCURRENCY, TILE_GLOBAL_CONCURRENCY and MAX_TILES must be at least 1")
+
+# Created on first use so it belongs to the server's event loop
+tile_call_semaphore = None
+
+# Deep Zoom tile pyramid settings for annotated image output
+PYRAMID_CACHE_DIR = os.getenv("PYRAMID_CACHE_DIR", os.path.join(tempfile.gettempdir(), "medico_pyramids"))
+PYRAMID_TILE_SIZE = int(os.getenv("PYRAMID_TILE_SIZE", "256"))
+PYRAMID_TILE_OVERLAP = int(os.getenv("PYRAMID_TILE_OVERLAP", "1"))
+PYRAMID_MAX_ENTRIES = int(os.getenv("PYRAMID_MAX_ENTRIES", "200"))  # Oldest pyramids are pruned beyond this
+PYRAMID_SCRATCH_MAX_AGE = int(os.getenv("PYRAMID_SCRATCH_MAX_AGE", "3600"))  # Seconds before an unfinished build is removed
+PREVIEW_MAX_SIZE = int(os.getenv("PREVIEW_MAX_SIZE", "256"))
+# Pyramids are patient images: browsers may cache them, shared proxies and CDNs must not
+PYRAMID_CACHE_HEADERS = {"Cache-Control": "private, max-age=3600"}
+
+# Persistent store of past analyses, so reopening a study does not call Gemini again
+ANALYSIS_DB_PATH = os.getenv("ANALYSIS_DB_PATH", "analyses.db")
+analysis_store = AnalysisStore(ANALYSIS_DB_PATH)
+ANALYSIS_API_TOKEN = os.getenv("ANALYSIS_API_TOKEN")  # /analyses endpoints are disabled when unset
+
+# Supported output modes for annotated image endpoints
+ANNOTATION_OUTPUT_MODES = ["image", "pyramid", "svg", "geojson"]
+VECTOR_OUTPUT_MODES = ["svg", "geojson"]
+
 # Medical Analysis Query
 MEDICAL_QUERY = """
 You are a highly skilled medical imaging expert with extensive knowledge in radiology and diagnostic imaging. Analyze the medical image and structure your response as follows:
@@ -129,16 +238,18 @@ def analyze_medical_image(image_file) -> str:
         img_byte_arr.seek(0)
         
         # Generate analysis using Gemini
-        response = model.generate_content([
+        response = generate_content([
             MEDICAL_QUERY,
             {
                 'mime_type': 'image/png',
                 'data': img_byte_arr.getvalue()
             }
-        ])
+        ], prompt_type="report")
         
         return response.text
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis error: {str(e)}")
 
@@ -166,27 +277,20 @@ def detect_abnormalities(image_file) -> dict:
         img_byte_arr.seek(0)
         
         # Generate annotation data using Gemini
-        response = model.generate_content([
+        response = generate_content([
             ANNOTATION_QUERY,
             {
                 'mime_type': 'image/png',
                 'data': img_byte_arr.getvalue()
             }
-        ])
+        ], prompt_type="annotation")
         
         print(f"Raw Gemini response for annotations: {response.text}")  # Debug print
         
         # Parse JSON response
         try:
-            # Extract JSON from response text
-            response_text = response.text.strip()
-            # Remove markdown code blocks if present
-            if response_text.startswith('```json'):
-                response_text = response_text[7:-3]
-            elif response_text.startswith('```'):
-                response_text = response_text[3:-3]
-            
-            abnormalities_data = json.loads(response_text)
+            response_text = response.text
+            abnormalities_data = parse_annotation_response(response_text)
             print(f"Parsed abnormalities: {abnormalities_data}")  # Debug print
             return abnormalities_data
         except json.JSONDecodeError as json_error:
@@ -196,6 +300,7 @@ def detect_abnormalities(image_file) -> dict:
             # Try to extract coordinates from text response manually if JSON fails
             # Create sample data based on the chest X-ray analysis
             sample_abnormalities = {
+                "fallback": True,  # Not from the model, never persisted or reused
                 "abnormalities": [
                     {
                         "description": "Bilateral pulmonary opacities - upper left lung",
@@ -225,10 +330,13 @@ def detect_abnormalities(image_file) -> dict:
             }
             return sample_abnormalities
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         print(f"Error in detect_abnormalities: {str(e)}")
         # Return sample data for testing purposes
         return {
+            "fallback": True,  # Not from the model, never persisted or reused
             "abnormalities": [
                 {
                     "description": "Sample abnormality for testing",
@@ -239,6 +347,303 @@ def detect_abnormalities(image_file) -> dict:
             ]
         }
 
+def parse_annotation_response(response_text: str) -> dict:
+    """Strip markdown code fences from a Gemini annotation response and parse the JSON."""
+    
+    response_text = response_text.strip()
+    if response_text.startswith('```json'):
+        response_text = response_text[7:-3]
+    elif response_text.startswith('```'):
+        response_text = response_text[3:-3]
+    
+    return json.loads(response_text)
+
+def parse_number(value, default: float = 0.0) -> float:
+    """Tolerant float parsing for model output such as 85, "85" or "85%"; falls back to default."""
+    
+    if isinstance(value, str):
+        value = value.strip().rstrip('%').strip()
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return default
+    # "nan" and "inf" parse as floats but break pixel math and JSON responses
+    return number if math.isfinite(number) else default
+
+def split_into_tiles(width: int, height: int, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP,
+                     max_tiles: int = MAX_TILES) -> List[Tuple[int, int, int, int]]:
+    """
+    Split an image of the given size into overlapping (left, top, right, bottom) tile boxes.
+    
+    If the image would need more than max_tiles tiles, the tile size is grown until it fits.
+    """
+    
+    if not 0 <= overlap < tile_size:
+        raise ValueError("overlap must be at least 0 and smaller than tile_size")
+    
+    def axis_starts(length: int) -> List[int]:
+        if length <= tile_size:
+            return [0]
+        stride = tile_size - overlap
+        starts = list(range(0, length - tile_size, stride))
+        # Make sure the last tile is flush with the image edge
+        starts.append(length - tile_size)
+        return starts
+    
+    while len(axis_starts(width)) * len(axis_starts(height)) > max_tiles:
+        tile_size = int(tile_size * 1.25) + 1
+    
+    return [
+        (left, top, min(left + tile_size, width), min(top + tile_size, height))
+        for top in axis_starts(height)
+        for left in axis_starts(width)
+    ]
+
+def tile_location_to_global(location: dict, tile_box: Tuple[int, int, int, int], img_width: int, img_height: int) -> dict:
+    """Map a tile-local percentage location to percentage coordinates of the full image."""
+    
+    if not isinstance(location, dict):
+        location = {}
+    left, top, right, bottom = tile_box
+    tile_width = right - left
+    tile_height = bottom - top
+    
+    center_x = left + (parse_number(location.get("x"), 50) / 100) * tile_width
+    center_y = top + (parse_number(location.get("y"), 50) / 100) * tile_height
+    width = (parse_number(location.get("width"), 10) / 100) * tile_width
+    height = (parse_number(location.get("height"), 10) / 100) * tile_height
+    
+    return {
+        "x": round(center_x / img_width * 100, 2),
+        "y": round(center_y / img_height * 100, 2),
+        "width": round(width / img_width * 100, 2),
+        "height": round(height / img_height * 100, 2)
+    }
+
+def box_iou(location_a: dict, location_b: dict) -> float:
+    """Intersection over union of two center-based percentage locations."""
+    
+    def corners(location: dict) -> Tuple[float, float, float, float]:
+        half_w = location.get("width", 10) / 2
+        half_h = location.get("height", 10) / 2
+        return (location.get("x", 50) - half_w, location.get("y", 50) - half_h,
+                location.get("x", 50) + half_w, location.get("y", 50) + half_h)
+    
+    ax1, ay1, ax2, ay2 = corners(location_a)
+    bx1, by1, bx2, by2 = corners(location_b)
+    
+    inter_w = max(0.0, min(ax2, bx2) - max(ax1, bx1))
+    inter_h = max(0.0, min(ay2, by2) - max(ay1, by1))
+    intersection = inter_w * inter_h
+    union = (ax2 - ax1) * (ay2 - ay1) + (bx2 - bx1) * (by2 - by1) - intersection
+    
+    return intersection / union if union > 0 else 0.0
+
+def non_max_suppression(abnormalities: List[dict], iou_threshold: float = NMS_IOU_THRESHOLD) -> List[dict]:
+    """Drop duplicate detections, keeping the most confident box of each overlapping group."""
+    
+    ranked = sorted(abnormalities, key=lambda a: parse_number(a.get("confidence")), reverse=True)
+    kept = []
+    for candidate in ranked:
+        if all(box_iou(candidate.get("location", {}), k.get("location", {})) <= iou_threshold for k in kept):
+            kept.append(candidate)
+    return kept
+
+def detect_abnormalities_in_tile(tile_image: PILImage.Image) -> List[dict]:
+    """
+    Run abnormality detection on a single full-resolution tile and return tile-local results.
+    
+    Raises if the model call fails or its response cannot be parsed, so callers can tell a
+    failed tile apart from a tile with no findings.
+    """
+    
+    img_byte_arr = io.BytesIO()
+    tile_image.save(img_byte_arr, format='PNG')
+    
+    response = generate_content([
+        ANNOTATION_QUERY,
+        {
+            'mime_type': 'image/png',
+            'data': img_byte_arr.getvalue()
+        }
+    ], prompt_type="annotation")
+    
+    abnormalities = parse_annotation_response(response.text).get("abnormalities", [])
+    if not isinstance(abnormalities, list):
+        raise ValueError("abnormalities is not a list")
+    return [a for a in abnormalities if isinstance(a, dict)]
+
+async def detect_abnormalities_tiled(image_file) -> dict:
+    """
+    Detect abnormal areas on a full-resolution image by analyzing overlapping tiles.
+    
+    Tiles are sent to Gemini concurrently (at most TILE_MAX_CONCURRENCY at a time), tile-local
+    boxes are mapped back to whole-image percentages and duplicates from overlapping tiles are
+    merged with non-maximum suppression. The result has the same shape as detect_abnormalities,
+    plus "total_tiles", "failed_tiles" and "partial" so a region whose tile failed is never
+    mistaken for a region without findings. Raises if every tile fails.
+    """
+    
+    image = PILImage.open(image_file)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    global tile_call_semaphore
+    if tile_call_semaphore is None:
+        tile_call_semaphore = asyncio.Semaphore(TILE_GLOBAL_CONCURRENCY)
+    
+    img_width, img_height = image.size
+    tile_boxes = split_into_tiles(img_width, img_height)
+    semaphore = asyncio.Semaphore(TILE_MAX_CONCURRENCY)
+    
+    async def run_tile(tile_box: Tuple[int, int, int, int]) -> Optional[List[dict]]:
+        async with semaphore, tile_call_semaphore:
+            try:
+                tile_results = await asyncio.to_thread(detect_abnormalities_in_tile, image.crop(tile_box))
+            except ServiceUnavailableError as e:
+                # An open circuit (503) fails the whole request; a single slow tile (504) is just a failed tile
+                if e.status_code == 503:
+                    raise
+                print(f"Tile {tile_box} timed out: {str(e)}")
+                return None
+            except Exception as e:
+                print(f"Error detecting abnormalities in tile {tile_box}: {str(e)}")
+                return None
+        
+        for abnormality in tile_results:
+            abnormality["location"] = tile_location_to_global(
+                abnormality.get("location", {}), tile_box, img_width, img_height
+            )
+        return tile_results
+    
+    print(f"Tiled detection: {len(tile_boxes)} tiles for {img_width}x{img_height} image")
+    tasks = [asyncio.ensure_future(run_tile(box)) for box in tile_boxes]
+    try:
+        tile_outputs = await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop tiles still waiting for a slot from making Gemini calls for a request that already failed
+        for task in tasks:
+            task.cancel()
+        raise
+    
+    failed_tiles = sum(1 for tile_results in tile_outputs if tile_results is None)
+    if failed_tiles == len(tile_boxes):
+        raise ServiceUnavailableError("Gemini detection failed for every tile", status_code=502)
+    
+    candidates = [abnormality for tile_results in tile_outputs if tile_results for abnormality in tile_results]
+    merged = non_max_suppression(candidates)
+    print(f"Tiled detection: {len(candidates)} raw detections merged into {len(merged)}, {failed_tiles} tiles failed")
+    
+    return {
+        "abnormalities": merged,
+        "total_tiles": len(tile_boxes),
+        "failed_tiles": failed_tiles,
+        "partial": failed_tiles > 0
+    }
+
+# Color mapping for severity levels
+SEVERITY_COLORS = {
+    "Low": "#FFFF00",      # Yellow
+    "Medium": "#FFA500",   # Orange
+    "High": "#FF0000"      # Red
+}
+
+def annotation_boxes(abnormalities_data: dict, img_width: int, img_height: int) -> List[dict]:
+    """Pixel bounding boxes, colors and labels for each abnormality, shared by raster and vector output."""
+    
+    boxes = []
+    for i, abnormality in enumerate(abnormalities_data.get("abnormalities", [])):
+        # Model output is untrusted: coerce every field so odd values never break rendering
+        if not isinstance(abnormality, dict):
+            abnormality = {}
+        location = abnormality.get("location")
+        if not isinstance(location, dict):
+            location = {}
+        severity = str(abnormality.get("severity") or "Medium")
+        confidence = abnormality.get("confidence", 0)
+        if not isinstance(confidence, int) or isinstance(confidence, bool):
+            confidence = parse_number(confidence)  # Also catches float NaN/inf, which JSONResponse cannot encode
+        confidence = min(max(confidence, 0), 100)
+        
+        # Convert percentage coordinates to pixel coordinates
+        center_x = int((parse_number(location.get("x"), 50) / 100) * img_width)
+        center_y = int((parse_number(location.get("y"), 50) / 100) * img_height)
+        width = int((parse_number(location.get("width"), 10) / 100) * img_width)
+        height = int((parse_number(location.get("height"), 10) / 100) * img_height)
+        
+        # Calculate bounding box, kept within image bounds
+        x1 = max(0, min(center_x - width // 2, img_width))
+        y1 = max(0, min(center_y - height // 2, img_height))
+        x2 = max(0, min(center_x + width // 2, img_width))
+        y2 = max(0, min(center_y + height // 2, img_height))
+        
+        boxes.append({
+            "index": i + 1,
+            "description": str(abnormality.get("description") or "Abnormality"),
+            "severity": severity,
+            "confidence": confidence,
+            "color": SEVERITY_COLORS.get(severity, "#FFA500"),
+            "label": f"{i+1}. {severity} ({confidence:g}%)",
+            "box": [x1, y1, x2, y2]
+        })
+    return boxes
+
+def build_svg_overlay(abnormalities_data: dict, img_width: int, img_height: int) -> str:
+    """SVG overlay in image pixel coordinates, drawn the same way annotate_image draws the raster version."""
+    
+    line_width = max(2, min(img_width, img_height) // 200)
+    font_size = max(12, min(img_width, img_height) // 50)
+    
+    elements = []
+    for box in annotation_boxes(abnormalities_data, img_width, img_height):
+        x1, y1, x2, y2 = box["box"]
+        color = quoteattr(box["color"])
+        label_y = max(0, y1 - font_size - 5)
+        # Approximate label width; the client renders the text itself
+        label_width = int(len(box["label"]) * font_size * 0.6) + 4
+        elements.append(
+            f'<g><title>{escape(box["description"])}</title>'
+            f'<rect x="{x1}" y="{y1}" width="{x2 - x1}" height="{y2 - y1}" fill={color} fill-opacity="0.2" '
+            f'stroke={color} stroke-width="{line_width}"/>'
+            f'<rect x="{x1}" y="{label_y}" width="{label_width}" height="{font_size + 4}" fill={color} stroke="black"/>'
+            f'<text x="{x1 + 2}" y="{label_y + font_size}">{escape(box["label"])}</text></g>'
+        )
+    
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{img_width}" height="{img_height}" '
+        f'viewBox="0 0 {img_width} {img_height}" font-family="Arial, sans-serif" font-size="{font_size}">'
+        + "".join(elements) + '</svg>'
+    )
+
+def build_geojson_overlay(abnormalities_data: dict, img_width: int, img_height: int) -> dict:
+    """GeoJSON FeatureCollection of abnormality boxes in image pixel coordinates (origin top-left, y down)."""
+    
+    features = []
+    for box in annotation_boxes(abnormalities_data, img_width, img_height):
+        x1, y1, x2, y2 = box["box"]
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]]
+            },
+            "properties": {key: value for key, value in box.items() if key != "box"}
+        })
+    
+    return {
+        "type": "FeatureCollection",
+        "image": {"width": img_width, "height": img_height},
+        "features": features
+    }
+
+def build_vector_overlay(image_file, abnormalities_data: dict, output: str):
+    """SVG string or GeoJSON dict overlay for the image; only the image header is read, not its pixels."""
+    
+    img_width, img_height = PILImage.open(image_file).size
+    if output == "svg":
+        return build_svg_overlay(abnormalities_data, img_width, img_height)
+    return build_geojson_overlay(abnormalities_data, img_width, img_height)
+
 def annotate_image(image_file, abnormalities_data: dict) -> PILImage.Image:
     """Annotate image with highlighted abnormal areas."""
     
@@ -254,43 +659,13 @@ def annotate_image(image_file, abnormalities_data: dict) -> PILImage.Image:
         annotated_image = image.copy()
         draw = ImageDraw.Draw(annotated_image)
         
-        # Color mapping for severity levels
-        severity_colors = {
-            "Low": "#FFFF00",      # Yellow
-            "Medium": "#FFA500",   # Orange
-            "High": "#FF0000"      # Red
-        }
-        
         # Get image dimensions
         img_width, img_height = image.size
         
         # Draw annotations for each abnormality
-        for i, abnormality in enumerate(abnormalities_data.get("abnormalities", [])):
-            location = abnormality.get("location", {})
-            severity = abnormality.get("severity", "Medium")
-            description = abnormality.get("description", "Abnormality")
-            confidence = abnormality.get("confidence", 0)
-            
-            # Convert percentage coordinates to pixel coordinates
-            center_x = int((location.get("x", 50) / 100) * img_width)
-            center_y = int((location.get("y", 50) / 100) * img_height)
-            width = int((location.get("width", 10) / 100) * img_width)
-            height = int((location.get("height", 10) / 100) * img_height)
-            
-            # Calculate bounding box
-            x1 = center_x - width // 2
-            y1 = center_y - height // 2
-            x2 = center_x + width // 2
-            y2 = center_y + height // 2
-            
-            # Ensure coordinates are within image bounds
-            x1 = max(0, min(x1, img_width))
-            y1 = max(0, min(y1, img_height))
-            x2 = max(0, min(x2, img_width))
-            y2 = max(0, min(y2, img_height))
-            
-            # Get color for severity
-            color = severity_colors.get(severity, "#FFA500")
+        for box in annotation_boxes(abnormalities_data, img_width, img_height):
+            x1, y1, x2, y2 = box["box"]
+            color = box["color"]
             
             # Draw bounding box
             line_width = max(2, min(img_width, img_height) // 200)
@@ -320,7 +695,7 @@ def annotate_image(image_file, abnormalities_data: dict) -> PILImage.Image:
                 font = ImageFont.load_default()
             
             # Create label text
-            label = f"{i+1}. {severity} ({confidence}%)"
+            label = box["label"]
             
             # Draw label background
             bbox = draw.textbbox((0, 0), label, font=font)
@@ -341,20 +716,238 @@ def annotate_image(image_file, abnormalities_data: dict) -> PILImage.Image:
         # Return original image if annotation fails
         return PILImage.open(image_file)
 
+def encode_png_base64(image: PILImage.Image) -> str:
+    """Encode an image as a PNG data URL."""
+    
+    img_buffer = io.BytesIO()
+    image.save(img_buffer, format='PNG')
+    return f"data:image/png;base64,{base64.b64encode(img_buffer.getvalue()).decode('utf-8')}"
+
+def make_preview(image: PILImage.Image) -> PILImage.Image:
+    """Downscaled copy of the image for instant display while tiles load."""
+    
+    preview = image.copy()
+    preview.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE), PILImage.Resampling.LANCZOS)
+    return preview
+
+def save_analysis(content: bytes, report: str, abnormalities_data: Optional[dict], filename: Optional[str],
+                  patient_id: Optional[str], study_id: Optional[str], detection_mode: Optional[str]) -> Optional[int]:
+    """Store an analysis with a thumbnail of the original image; storage errors never fail the request."""
+    
+    try:
+        thumbnail_buffer = io.BytesIO()
+        make_preview(PILImage.open(io.BytesIO(content)).convert('RGB')).save(thumbnail_buffer, format='PNG')
+        return analysis_store.save(
+            image_hash(content), report, abnormalities_data,
+            thumbnail=thumbnail_buffer.getvalue(), patient_id=patient_id, study_id=study_id,
+            filename=filename, detection_mode=detection_mode
+        )
+    except Exception as e:
+        print(f"Error saving analysis: {str(e)}")
+        return None
+
+def is_reliable_detection(abnormalities_data: dict) -> bool:
+    """True only for detections from a real, fully parsed model response, the only kind worth storing."""
+    return not abnormalities_data.get("fallback") and not abnormalities_data.get("partial")
+
+def reuse_analysis(cached: dict, content: bytes, filename: Optional[str], patient_id: Optional[str],
+                   study_id: Optional[str]) -> Optional[int]:
+    """
+    Id to return for a stored analysis of the same image. A stored row of another patient or
+    study is copied under the caller's IDs, so one patient's record id is never handed to another.
+    """
+    
+    if cached["patient_id"] == patient_id and cached["study_id"] == study_id:
+        return cached["id"]
+    return save_analysis(content, cached["report"], cached["abnormalities"], filename,
+                         patient_id, study_id, cached["detection_mode"])
+
+def pyramid_id_for(content: bytes, abnormalities_data: dict) -> str:
+    """Cache key for the annotated pyramid of an image and its abnormalities."""
+    
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps(abnormalities_data, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+def pyramid_manifest(pyramid_id: str, width: int, height: int) -> dict:
+    """Describe a stored pyramid and where the viewer can fetch its parts."""
+    
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    return {
+        "id": pyramid_id,
+        "width": width,
+        "height": height,
+        "tile_size": PYRAMID_TILE_SIZE,
+        "overlap": PYRAMID_TILE_OVERLAP,
+        "format": "png",
+        "max_level": max_level,
+        "dzi_url": f"/pyramids/{pyramid_id}/image.dzi",
+        "tile_url": f"/pyramids/{pyramid_id}/image_files/{{level}}/{{col}}_{{row}}.png",
+        "preview_url": f"/pyramids/{pyramid_id}/preview.png"
+    }
+
+def build_tile_pyramid(image: PILImage.Image, pyramid_id: str) -> dict:
+    """
+    Write a Deep Zoom (DZI) tile pyramid and a preview thumbnail of the image to the cache.
+    
+    Level max_level is full resolution and every level below halves the previous one, down to
+    a single pixel at level 0. Pyramids are built in a scratch directory and moved into place,
+    so concurrent requests for the same image never see a half-written pyramid.
+    """
+    
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    width, height = image.size
+    manifest = pyramid_manifest(pyramid_id, width, height)
+    target_dir = os.path.join(PYRAMID_CACHE_DIR, pyramid_id)
+    
+    try:
+        os.utime(target_dir)  # Mark as recently used for pruning
+        return manifest
+    except FileNotFoundError:
+        pass  # Not cached yet, or pruned by another worker
+    
+    os.makedirs(PYRAMID_CACHE_DIR, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=f".{pyramid_id}-", dir=PYRAMID_CACHE_DIR)
+    
+    try:
+        tile_size = PYRAMID_TILE_SIZE
+        overlap = PYRAMID_TILE_OVERLAP
+        level_image = image
+        
+        for level in range(manifest["max_level"], -1, -1):
+            level_width, level_height = level_image.size
+            level_dir = os.path.join(build_dir, "image_files", str(level))
+            os.makedirs(level_dir)
+            
+            for col in range(math.ceil(level_width / tile_size)):
+                for row in range(math.ceil(level_height / tile_size)):
+                    left = max(0, col * tile_size - overlap)
+                    top = max(0, row * tile_size - overlap)
+                    right = min(level_width, (col + 1) * tile_size + overlap)
+                    bottom = min(level_height, (row + 1) * tile_size + overlap)
+                    level_image.crop((left, top, right, bottom)).save(
+                        os.path.join(level_dir, f"{col}_{row}.png"), format='PNG'
+                    )
+            
+            # Each level is half the size of the one above it, rounded up
+            next_size = (max(1, math.ceil(level_width / 2)), max(1, math.ceil(level_height / 2)))
+            level_image = level_image.resize(next_size, PILImage.Resampling.LANCZOS)
+        
+        with open(os.path.join(build_dir, "image.dzi"), "w") as dzi_file:
+            dzi_file.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" '
+                f'Overlap="{overlap}" Format="png">\n'
+                f'  <Size Width="{width}" Height="{height}"/>\n'
+                '</Image>\n'
+            )
+        
+        make_preview(image).save(os.path.join(build_dir, "preview.png"), format='PNG')
+        
+        try:
+            os.rename(build_dir, target_dir)
+        except OSError:
+            # Another request finished the same pyramid first
+            shutil.rmtree(build_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    
+    prune_pyramid_cache()
+    return manifest
+
+def prune_pyramid_cache(max_entries: int = PYRAMID_MAX_ENTRIES):
+    """
+    Delete the least recently used pyramids once the cache holds more than max_entries, and
+    scratch directories left behind by builds that crashed before moving into place.
+    """
+    
+    pyramids = []
+    try:
+        for entry in os.scandir(PYRAMID_CACHE_DIR):
+            try:
+                if not entry.is_dir():
+                    continue
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue  # Removed by another worker while we were scanning
+            
+            if entry.name.startswith('.'):
+                if time.time() - mtime > PYRAMID_SCRATCH_MAX_AGE:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                pyramids.append((mtime, entry.path))
+    except FileNotFoundError:
+        return
+    
+    pyramids.sort(reverse=True)
+    for _, path in pyramids[max_entries:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def pyramid_file_path(pyramid_id: str, *parts: str) -> str:
+    """Resolve a file inside a cached pyramid, rejecting ids that could escape the cache directory."""
+    
+    if not re.fullmatch(r"[0-9a-f]{32}", pyramid_id):
+        raise HTTPException(status_code=404, detail="Pyramid not found")
+    
+    path = os.path.join(PYRAMID_CACHE_DIR, pyramid_id, *parts)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Pyramid file not found")
+    return path
+
 @app.get("/")
 async def root():
     return {"message": "Medical Image Analysis API with Annotation", "version": "1.0.0"}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "message": "API is running"}
+    return {"status": "healthy", "message": "API is running", "gemini": {
+        prompt_type: caller.status() for prompt_type, caller in gemini_callers.items()
+    }}
+
+@app.get("/admin/profiling")
+async def get_profiling_status(x_admin_token: Optional[str] = Header(None)):
+    """Current profiling settings and recent slow request and memory reports."""
+    if not profiling.is_authorized(x_admin_token):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return profiler.status()
+
+@app.post("/admin/profiling")
+async def configure_profiling(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """
+    Change profiling settings without a restart.
+    
+    - **tracemalloc**: true/false to toggle per-request allocation snapshots
+    - **slow_request_ms**: threshold for the slow request log, 0 to disable
+    """
+    if not profiling.is_authorized(x_admin_token):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    
+    try:
+        data = await request.json()
+        return profiler.configure(**profiling.parse_settings(data))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/admin/profiling/cpu")
+async def profile_cpu(seconds: float = 5, x_admin_token: Optional[str] = Header(None)):
+    """Sampling CPU profile of all threads for the given window (max 60 seconds)."""
+    if not profiling.is_authorized(x_admin_token):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    
+    return await asyncio.to_thread(profiler.sample_cpu, min(seconds, 60))
 
 @app.post("/analyze-image")
-async def analyze_image(file: UploadFile = File(...)):
+async def analyze_image(file: UploadFile = File(...), patient_id: Optional[str] = None,
+                        study_id: Optional[str] = None, refresh: bool = False):
     """
     Analyze a medical image and return detailed findings.
     
     - **file**: Medical image file (jpg, jpeg, png, bmp, gif)
+    - **patient_id** / **study_id**: Optional identifiers stored with the analysis
+    - **refresh**: Re-run the analysis even if this image was analyzed before
     """
     
     # Check file type
@@ -376,30 +969,51 @@ async def analyze_image(file: UploadFile = File(...)):
         )
     
     try:
-        # Create a BytesIO object from the file content
-        image_file = io.BytesIO(content)
-        
-        # Analyze the image
-        report = analyze_medical_image(image_file)
+        # Reuse a stored report for an image we have already seen
+        cached = None if refresh else analysis_store.latest_by_hash(image_hash(content))
+        if cached:
+            report = cached["report"]
+            analysis_id = reuse_analysis(cached, content, file.filename, patient_id, study_id)
+        else:
+            # Create a BytesIO object from the file content
+            image_file = io.BytesIO(content)
+            
+            # Analyze the image
+            report = await asyncio.to_thread(analyze_medical_image, image_file)
+            analysis_id = save_analysis(content, report, None, file.filename, patient_id, study_id, None)
         
         return JSONResponse(content={
             "status": "success",
             "filename": file.filename,
             "analysis": report,
+            "analysis_id": analysis_id,
+            "cached": cached is not None,
             "message": "Image analyzed successfully"
         })
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
 
 @app.post("/analyze-with-annotation")
-async def analyze_with_annotation(file: UploadFile = File(...)):
+async def analyze_with_annotation(file: UploadFile = File(...), tiled: bool = False, output: str = "image",
+                                  patient_id: Optional[str] = None, study_id: Optional[str] = None,
+                                  refresh: bool = False):
     """
     Analyze a medical image and return both the analysis and an annotated image with highlighted abnormal areas.
     
     - **file**: Medical image file (jpg, jpeg, png, bmp, gif)
+    - **tiled**: Detect abnormalities on full-resolution overlapping tiles instead of a downscaled copy
+    - **output**: "image" for an inline base64 PNG, "pyramid" for a preview plus a Deep Zoom tile pyramid,
+      "svg" or "geojson" for a vector overlay to composite over the client's own copy of the image
+    - **patient_id** / **study_id**: Optional identifiers stored with the analysis
+    - **refresh**: Re-run the analysis even if this image was analyzed before
     """
     
+    if output not in ANNOTATION_OUTPUT_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid output mode. Use one of: {', '.join(ANNOTATION_OUTPUT_MODES)}")
+    
     # Check file type
     if file.content_type not in ["image/jpeg", "image/jpg", "image/png", "image/bmp", "image/gif"]:
         raise HTTPException(
@@ -425,21 +1039,85 @@ async def analyze_with_annotation(file: UploadFile = File(...)):
         detection_file = io.BytesIO(content)
         annotation_file = io.BytesIO(content)
         
-        # Step 1: Analyze the image
-        print("Step 1: Starting medical analysis...")
-        report = analyze_medical_image(analysis_file)
-        print("✓ Medical analysis completed")
+        detection_mode = "tiled" if tiled else "standard"
+        cached = None if refresh else analysis_store.latest_by_hash(
+            image_hash(content), detection_mode, require_abnormalities=True
+        )
+        
+        if cached:
+            # Steps 1-2: Reuse the stored analysis of this image
+            print(f"✓ Reusing stored analysis {cached['id']}")
+            report = cached["report"]
+            abnormalities_data = cached["abnormalities"]
+            analysis_id = reuse_analysis(cached, content, file.filename, patient_id, study_id)
+        else:
+            # Step 1: Analyze the image
+            print("Step 1: Starting medical analysis...")
+            report = await asyncio.to_thread(analyze_medical_image, analysis_file)
+            print("✓ Medical analysis completed")
+            
+            # Step 2: Detect abnormalities for annotation
+            print("Step 2: Detecting abnormalities...")
+            if tiled:
+                abnormalities_data = await detect_abnormalities_tiled(detection_file)
+            else:
+                abnormalities_data = await asyncio.to_thread(detect_abnormalities, detection_file)
+            print(f"✓ Found {len(abnormalities_data.get('abnormalities', []))} abnormalities")
+            
+            # Fallback sample boxes and partial tiled results must never be served as a stored analysis
+            analysis_id = None if not is_reliable_detection(abnormalities_data) else save_analysis(
+                content, report, abnormalities_data, file.filename, patient_id, study_id, detection_mode
+            )
         
-        # Step 2: Detect abnormalities for annotation
-        print("Step 2: Detecting abnormalities...")
-        abnormalities_data = detect_abnormalities(detection_file)
-        print(f"✓ Found {len(abnormalities_data.get('abnormalities', []))} abnormalities")
+        if output in VECTOR_OUTPUT_MODES:
+            # Step 3: Vector overlay only, the client already has the image pixels
+            print(f"Step 3: Building {output} overlay...")
+            return JSONResponse(content={
+                "status": "success",
+                "filename": file.filename,
+                "analysis": report,
+                "analysis_id": analysis_id,
+                "cached": cached is not None,
+                "abnormalities": abnormalities_data,
+                "annotated_image": None,
+                "overlay_format": output,
+                "overlay": build_vector_overlay(annotation_file, abnormalities_data, output),
+                "image_info": {
+                    "original_size_bytes": file_size,
+                    "abnormalities_count": len(abnormalities_data.get('abnormalities', []))
+                },
+                "message": "Image analyzed and annotated successfully"
+            })
         
         # Step 3: Create annotated image
         print("Step 3: Creating annotated image...")
         annotated_image = annotate_image(annotation_file, abnormalities_data)
         print("✓ Image annotation completed")
         
+        if output == "pyramid":
+            # Step 4: Build tile pyramid so the viewer can load detail on demand
+            print("Step 4: Building tile pyramid...")
+            pyramid_id = pyramid_id_for(content, abnormalities_data)
+            manifest = await asyncio.to_thread(build_tile_pyramid, annotated_image, pyramid_id)
+            print(f"✓ Tile pyramid ready: {pyramid_id}")
+            
+            return JSONResponse(content={
+                "status": "success",
+                "filename": file.filename,
+                "analysis": report,
+                "analysis_id": analysis_id,
+                "cached": cached is not None,
+                "abnormalities": abnormalities_data,
+                "annotated_image": None,
+                "preview_image": encode_png_base64(make_preview(annotated_image)),
+                "pyramid": manifest,
+                "image_info": {
+                    "original_size_bytes": file_size,
+                    "abnormalities_count": len(abnormalities_data.get('abnormalities', []))
+                },
+                "message": "Image analyzed and annotated successfully"
+            })
+        
         # Step 4: Convert annotated image to base64
         print("Step 4: Converting to base64...")
         img_buffer = io.BytesIO()
@@ -459,6 +1137,8 @@ async def analyze_with_annotation(file: UploadFile = File(...)):
             "status": "success",
             "filename": file.filename,
             "analysis": report,
+            "analysis_id": analysis_id,
+            "cached": cached is not None,
             "abnormalities": abnormalities_data,
             "annotated_image": f"data:image/png;base64,{annotated_image_b64}",
             "image_info": {
@@ -473,6 +1153,8 @@ async def analyze_with_annotation(file: UploadFile = File(...)):
         print("✓ Response prepared successfully")
         return JSONResponse(content=response_data)
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         print(f"❌ Error in analyze_with_annotation: {str(e)}")
         import traceback
@@ -481,7 +1163,7 @@ async def analyze_with_annotation(file: UploadFile = File(...)):
         # Try to return at least the analysis if annotation fails
         try:
             analysis_file = io.BytesIO(content)
-            report = analyze_medical_image(analysis_file)
+            report = await asyncio.to_thread(analyze_medical_image, analysis_file)
             
             return JSONResponse(content={
                 "status": "partial_success",
@@ -496,13 +1178,19 @@ async def analyze_with_annotation(file: UploadFile = File(...)):
             raise HTTPException(status_code=500, detail=f"Failed to analyze image: {str(e)}")
 
 @app.post("/get-annotated-image")
-async def get_annotated_image(file: UploadFile = File(...)):
+async def get_annotated_image(file: UploadFile = File(...), tiled: bool = False, output: str = "image"):
     """
     Return only the annotated image with highlighted abnormal areas.
     
     - **file**: Medical image file (jpg, jpeg, png, bmp, gif)
+    - **tiled**: Detect abnormalities on full-resolution overlapping tiles instead of a downscaled copy
+    - **output**: "image" for the PNG itself, "pyramid" for a preview plus a Deep Zoom tile pyramid,
+      "svg" or "geojson" for a vector overlay to composite over the client's own copy of the image
     """
     
+    if output not in ANNOTATION_OUTPUT_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid output mode. Use one of: {', '.join(ANNOTATION_OUTPUT_MODES)}")
+    
     # Check file type
     if file.content_type not in ["image/jpeg", "image/jpg", "image/png", "image/bmp", "image/gif"]:
         raise HTTPException(
@@ -517,12 +1205,37 @@ async def get_annotated_image(file: UploadFile = File(...)):
         image_file = io.BytesIO(content)
         
         # Detect abnormalities for annotation
-        abnormalities_data = detect_abnormalities(image_file)
+        if tiled:
+            abnormalities_data = await detect_abnormalities_tiled(image_file)
+        else:
+            abnormalities_data = await asyncio.to_thread(detect_abnormalities, image_file)
         
-        # Create annotated image
         image_file_annotation = io.BytesIO(content)
+        
+        if output == "svg":
+            return Response(
+                content=build_vector_overlay(image_file_annotation, abnormalities_data, output),
+                media_type="image/svg+xml"
+            )
+        if output == "geojson":
+            return JSONResponse(
+                content=build_vector_overlay(image_file_annotation, abnormalities_data, output),
+                media_type="application/geo+json"
+            )
+        
+        # Create annotated image
         annotated_image = annotate_image(image_file_annotation, abnormalities_data)
         
+        if output == "pyramid":
+            pyramid_id = pyramid_id_for(content, abnormalities_data)
+            manifest = await asyncio.to_thread(build_tile_pyramid, annotated_image, pyramid_id)
+            return JSONResponse(content={
+                "status": "success",
+                "filename": file.filename,
+                "preview_image": encode_png_base64(make_preview(annotated_image)),
+                "pyramid": manifest
+            })
+        
         # Return image as streaming response
         img_buffer = io.BytesIO()
         annotated_image.save(img_buffer, format='PNG')
@@ -534,14 +1247,16 @@ async def get_annotated_image(file: UploadFile = File(...)):
             headers={"Content-Disposition": f"inline; filename=annotated_{file.filename}"}
         )
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/annotate-chest-nodules")
 async def annotate_chest_nodules(file: UploadFile = File(...)):
     """
-    Create annotations for chest X-ray with multiple pulmonary nodules based on typical patterns.
-    This endpoint creates realistic annotations for chest X-rays showing nodular patterns.
+    Annotate pulmonary nodules on a chest X-ray.
+    Large films are analyzed as overlapping full-resolution tiles so small nodules are not lost to downscaling.
     """
     
     if file.content_type not in ["image/jpeg", "image/jpg", "image/png", "image/bmp", "image/gif"]:
@@ -553,47 +1268,8 @@ async def annotate_chest_nodules(file: UploadFile = File(...)):
     try:
         content = await file.read()
         
-        # Create realistic nodule annotations for chest X-ray
-        chest_nodules = {
-            "abnormalities": [
-                {
-                    "description": "Right upper lobe pulmonary nodule",
-                    "location": {"x": 70, "y": 25, "width": 8, "height": 8},
-                    "severity": "High",
-                    "confidence": 90
-                },
-                {
-                    "description": "Right middle lobe nodular opacity",
-                    "location": {"x": 75, "y": 40, "width": 6, "height": 6},
-                    "severity": "High",
-                    "confidence": 85
-                },
-                {
-                    "description": "Right lower lobe scattered nodules",
-                    "location": {"x": 65, "y": 60, "width": 12, "height": 10},
-                    "severity": "Medium",
-                    "confidence": 80
-                },
-                {
-                    "description": "Right hilar region nodular density",
-                    "location": {"x": 60, "y": 45, "width": 10, "height": 8},
-                    "severity": "High",
-                    "confidence": 88
-                },
-                {
-                    "description": "Right peripheral lung nodules",
-                    "location": {"x": 80, "y": 35, "width": 7, "height": 7},
-                    "severity": "Medium",
-                    "confidence": 82
-                },
-                {
-                    "description": "Right lower zone multiple small nodules",
-                    "location": {"x": 68, "y": 70, "width": 15, "height": 12},
-                    "severity": "Medium",
-                    "confidence": 78
-                }
-            ]
-        }
+        # Small nodules are lost when the film is downscaled, so detect on full-resolution tiles
+        chest_nodules = await detect_abnormalities_tiled(io.BytesIO(content))
         
         # Create annotated image
         image_file = io.BytesIO(content)
@@ -610,9 +1286,11 @@ async def annotate_chest_nodules(file: UploadFile = File(...)):
             "filename": file.filename,
             "abnormalities": chest_nodules,
             "annotated_image": f"data:image/png;base64,{annotated_image_b64}",
-            "message": "Chest nodules annotated successfully based on typical pattern"
+            "message": "Chest nodules annotated successfully"
         })
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Annotation failed: {str(e)}")
 
@@ -682,6 +1360,85 @@ async def test_annotation(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Test annotation failed: {str(e)}")
 
+@app.get("/pyramids/{pyramid_id}/image.dzi")
+async def get_pyramid_descriptor(pyramid_id: str):
+    """Deep Zoom descriptor for a cached annotated image pyramid."""
+    return FileResponse(pyramid_file_path(pyramid_id, "image.dzi"), media_type="application/xml",
+                        headers=PYRAMID_CACHE_HEADERS)
+
+@app.get("/pyramids/{pyramid_id}/preview.png")
+async def get_pyramid_preview(pyramid_id: str):
+    """Low resolution preview of a cached annotated image pyramid."""
+    return FileResponse(pyramid_file_path(pyramid_id, "preview.png"), media_type="image/png",
+                        headers=PYRAMID_CACHE_HEADERS)
+
+@app.get("/pyramids/{pyramid_id}/image_files/{level}/{tile_name}")
+async def get_pyramid_tile(pyramid_id: str, level: int, tile_name: str):
+    """Single tile of a cached annotated image pyramid, named {col}_{row}.png."""
+    
+    if not re.fullmatch(r"\d+_\d+\.png", tile_name):
+        raise HTTPException(status_code=404, detail="Tile not found")
+    
+    return FileResponse(
+        pyramid_file_path(pyramid_id, "image_files", str(level), tile_name),
+        media_type="image/png",
+        headers=PYRAMID_CACHE_HEADERS
+    )
+
+def require_analysis_token(token: Optional[str]):
+    """Reject /analyses reads unless the X-Analysis-Token header matches ANALYSIS_API_TOKEN."""
+    if not ANALYSIS_API_TOKEN or not token or not hmac.compare_digest(token, ANALYSIS_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+
+@app.get("/analyses")
+async def list_analyses(patient_id: Optional[str] = None, study_id: Optional[str] = None,
+                        min_severity: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                        limit: int = 20, cursor: Optional[int] = None, x_analysis_token: Optional[str] = Header(None)):
+    """
+    List stored analyses, newest first. Requires the X-Analysis-Token header.
+    
+    - **patient_id** / **study_id**: Filter by identifier
+    - **min_severity**: Only analyses whose most severe finding is at least Low/Medium/High
+    - **since** / **until**: ISO 8601 timestamps bounding created_at, UTC when no offset is given
+    - **limit**: Page size (max 100)
+    - **cursor**: next_cursor from the previous page
+    """
+    require_analysis_token(x_analysis_token)
+    try:
+        return analysis_store.list(
+            patient_id=patient_id, study_id=study_id, min_severity=min_severity,
+            since=since, until=until, limit=max(1, min(limit, 100)), cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/analyses/by-hash/{image_sha256}")
+async def get_analysis_by_hash(image_sha256: str, x_analysis_token: Optional[str] = Header(None)):
+    """Most recent stored analysis of an image, looked up by the SHA-256 of its bytes."""
+    require_analysis_token(x_analysis_token)
+    record = analysis_store.latest_by_hash(image_sha256.lower())
+    if record is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    return record
+
+@app.get("/analyses/{analysis_id}")
+async def get_analysis(analysis_id: int, x_analysis_token: Optional[str] = Header(None)):
+    """Full stored analysis including report and abnormalities."""
+    require_analysis_token(x_analysis_token)
+    record = analysis_store.get(analysis_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    return record
+
+@app.get("/analyses/{analysis_id}/thumbnail.png")
+async def get_analysis_thumbnail(analysis_id: int, x_analysis_token: Optional[str] = Header(None)):
+    """Thumbnail of the original image of a stored analysis."""
+    require_analysis_token(x_analysis_token)
+    thumbnail = analysis_store.thumbnail(analysis_id)
+    if thumbnail is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return Response(content=thumbnail, media_type="image/png", headers={"Cache-Control": "private, no-store"})
+
 @app.post("/analyze-image-simple")
 async def analyze_image_simple(file: UploadFile = File(...)):
     """
@@ -696,9 +1453,11 @@ async def analyze_image_simple(file: UploadFile = File(...)):
     try:
         content = await file.read()
         image_file = io.BytesIO(content)
-        report = analyze_medical_image(image_file)
+        report = await asyncio.to_thread(analyze_medical_image, image_file)
         return {"analysis": report}
         
+    except ServiceUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,256 @@
+# profiling.py
+"""
+Opt-in runtime profiling shared by app.py (Flask) and main.py (FastAPI).
+
+Everything is off by default and can be switched on without a restart, either through the
+services' /admin/profiling endpoints or by sending SIGUSR2 to a worker process:
+
+- sample_cpu: sampling CPU profile of every thread for a time window
+- tracemalloc: per-request snapshot diff of the top allocating source lines
+- slow request log: stack samples for requests slower than a threshold
+
+Only the standard library is used so the hooks cost nothing when disabled.
+
+Settings live in the worker process: an /admin/profiling call or a signal only toggles the
+one process that receives it, so with several gunicorn/uvicorn workers each one has to be
+toggled (and queried) separately. tracemalloc tracing is process-wide, so a request's memory
+diff also includes allocations made by any other request in flight in the same process.
+"""
+import hmac
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from typing import Optional, List
+
+PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN")  # Admin endpoints are disabled when unset
+DEFAULT_SLOW_REQUEST_MS = int(os.getenv("PROFILING_SLOW_REQUEST_MS", "2000"))
+SAMPLE_INTERVAL = float(os.getenv("PROFILING_SAMPLE_INTERVAL", "0.01"))  # Seconds between stack samples
+MAX_STACK_DEPTH = 30
+TOP_N = 20
+HISTORY_SIZE = 50  # Reports kept per kind for the admin endpoint
+
+
+def is_authorized(token: Optional[str]) -> bool:
+    """Check an admin token against PROFILING_ADMIN_TOKEN."""
+    if not PROFILING_ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token, PROFILING_ADMIN_TOKEN)
+
+
+def parse_settings(data) -> dict:
+    """
+    Validate an /admin/profiling request body into Profiler.configure() arguments.
+
+    Raises ValueError unless tracemalloc is a JSON boolean and slow_request_ms a non-negative
+    integer, so strings like "false" are rejected instead of being read as truthy.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+
+    tracemalloc_enabled = data.get("tracemalloc")
+    if tracemalloc_enabled is not None and not isinstance(tracemalloc_enabled, bool):
+        raise ValueError("tracemalloc must be true or false")
+
+    slow_request_ms = data.get("slow_request_ms")
+    if slow_request_ms is not None and (
+        isinstance(slow_request_ms, bool) or not isinstance(slow_request_ms, int) or slow_request_ms < 0
+    ):
+        raise ValueError("slow_request_ms must be a non-negative integer")
+
+    return {"tracemalloc_enabled": tracemalloc_enabled, "slow_request_ms": slow_request_ms}
+
+
+def _frame_stack(frame) -> List[str]:
+    """Outermost-first list of "file:line function" entries for a frame."""
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _summarize_stacks(stacks: Counter, total: int) -> dict:
+    """Turn collapsed stack counts into self/cumulative function tables."""
+    self_counts = Counter()
+    cumulative_counts = Counter()
+    for stack, count in stacks.items():
+        entries = stack.split(";")
+        self_counts[entries[-1]] += count
+        for entry in set(entries):
+            cumulative_counts[entry] += count
+
+    def table(counts):
+        return [
+            {"function": name, "samples": count, "percent": round(100 * count / total, 1)}
+            for name, count in counts.most_common(TOP_N)
+        ]
+
+    return {
+        "samples": total,
+        "top_self": table(self_counts) if total else [],
+        "top_cumulative": table(cumulative_counts) if total else [],
+        # Collapsed "a;b;c count" lines, ready for flamegraph tools
+        "collapsed": [f"{stack} {count}" for stack, count in stacks.most_common(TOP_N * 5)],
+    }
+
+
+class RequestTrace:
+    """Profiling state for one in-flight request."""
+
+    def __init__(self, name: str, snapshot, thread_id: Optional[int] = None):
+        self.name = name
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.started = time.perf_counter()
+        self.snapshot = snapshot
+        self.stacks = Counter()
+
+
+class Profiler:
+    """Runtime-toggleable profiling hooks for a single service process."""
+
+    def __init__(self, service_name: str):
+        self.service_name = service_name
+        self.tracemalloc_enabled = False
+        self.slow_request_ms = None  # None disables the slow request log
+        self.slow_requests = deque(maxlen=HISTORY_SIZE)
+        self.memory_reports = deque(maxlen=HISTORY_SIZE)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler_stop = None
+
+    def status(self) -> dict:
+        return {
+            "service": self.service_name,
+            "pid": os.getpid(),
+            "tracemalloc": self.tracemalloc_enabled,
+            "slow_request_ms": self.slow_request_ms,
+            "in_flight": len(self._active),
+            "slow_requests": list(self.slow_requests),
+            "memory_reports": list(self.memory_reports),
+        }
+
+    def configure(self, tracemalloc_enabled: Optional[bool] = None, slow_request_ms: Optional[int] = None) -> dict:
+        """
+        Change profiling settings at runtime. Arguments left as None are unchanged;
+        slow_request_ms=0 turns the slow request log off.
+        """
+        if tracemalloc_enabled is not None:
+            if tracemalloc_enabled and not tracemalloc.is_tracing():
+                tracemalloc.start(MAX_STACK_DEPTH)
+            elif not tracemalloc_enabled and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self.tracemalloc_enabled = tracemalloc_enabled
+
+        if slow_request_ms is not None:
+            self.slow_request_ms = slow_request_ms if slow_request_ms > 0 else None
+            if self.slow_request_ms and self._sampler_stop is None:
+                self._start_sampler()
+            elif not self.slow_request_ms and self._sampler_stop is not None:
+                self._sampler_stop.set()
+                self._sampler_stop = None
+
+        print(f"[profiling] {self.service_name}: tracemalloc={self.tracemalloc_enabled}, slow_request_ms={self.slow_request_ms}")
+        return self.status()
+
+    def toggle(self) -> dict:
+        """Switch all per-request profiling on with defaults, or everything off."""
+        if self.tracemalloc_enabled or self.slow_request_ms:
+            return self.configure(tracemalloc_enabled=False, slow_request_ms=0)
+        return self.configure(tracemalloc_enabled=True, slow_request_ms=DEFAULT_SLOW_REQUEST_MS)
+
+    @property
+    def takes_snapshots(self) -> bool:
+        """Whether begin/end_request take tracemalloc snapshots, which are slow enough to block an event loop."""
+        return self.tracemalloc_enabled
+
+    def begin_request(self, name: str, thread_id: Optional[int] = None) -> Optional[RequestTrace]:
+        """
+        Start tracing a request; returns None when profiling is off.
+
+        thread_id is the thread serving the request, for callers that run this from another thread.
+        """
+        if not (self.tracemalloc_enabled or self.slow_request_ms):
+            return None
+
+        snapshot = tracemalloc.take_snapshot() if self.tracemalloc_enabled and tracemalloc.is_tracing() else None
+        trace = RequestTrace(name, snapshot, thread_id)
+        with self._lock:
+            self._active[id(trace)] = trace
+        return trace
+
+    def end_request(self, trace: Optional[RequestTrace]):
+        """Finish tracing a request and record any reports it produced."""
+        if trace is None:
+            return
+
+        with self._lock:
+            self._active.pop(id(trace), None)
+        duration_ms = (time.perf_counter() - trace.started) * 1000
+
+        if trace.snapshot is not None and tracemalloc.is_tracing():
+            # Process-wide: includes allocations from other requests running at the same time
+            diff = tracemalloc.take_snapshot().compare_to(trace.snapshot, "lineno")
+            self.memory_reports.append({
+                "request": trace.name,
+                "duration_ms": round(duration_ms, 1),
+                "top_allocations": [
+                    {"line": str(stat.traceback[0]), "size_kb": round(stat.size_diff / 1024, 1), "count": stat.count_diff}
+                    for stat in diff[:TOP_N]
+                ],
+            })
+
+        if self.slow_request_ms and duration_ms >= self.slow_request_ms:
+            report = {"request": trace.name, "duration_ms": round(duration_ms, 1)}
+            report.update(_summarize_stacks(trace.stacks, sum(trace.stacks.values())))
+            self.slow_requests.append(report)
+            print(f"[profiling] slow request {trace.name}: {duration_ms:.0f}ms ({report['samples']} stack samples)")
+
+    def sample_cpu(self, seconds: float, interval: float = SAMPLE_INTERVAL) -> dict:
+        """Sample the stacks of all other threads for the given window; blocks the calling thread."""
+        own_thread = threading.get_ident()
+        stacks = Counter()
+        deadline = time.perf_counter() + seconds
+
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread:
+                    stacks[";".join(_frame_stack(frame))] += 1
+            time.sleep(interval)
+
+        report = {"service": self.service_name, "seconds": seconds, "interval": interval}
+        report.update(_summarize_stacks(stacks, sum(stacks.values())))
+        return report
+
+    def _start_sampler(self):
+        """Background thread that samples the stacks of in-flight requests."""
+        stop = threading.Event()
+        self._sampler_stop = stop
+
+        def run():
+            while not stop.wait(SAMPLE_INTERVAL):
+                frames = sys._current_frames()
+                with self._lock:
+                    traces = list(self._active.values())
+                for trace in traces:
+                    frame = frames.get(trace.thread_id)
+                    if frame is not None:
+                        trace.stacks[";".join(_frame_stack(frame))] += 1
+
+        threading.Thread(target=run, name=f"{self.service_name}-profiler", daemon=True).start()
+
+
+def install_signal_toggle(profiler: Profiler):
+    """Toggle profiling on SIGUSR2. A no-op where the signal or main thread is unavailable."""
+    if not hasattr(signal, "SIGUSR2"):
+        return
+    try:
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        pass
@@ -0,0 +1,227 @@
+# resilience.py
+"""
+Tail-latency controls for calls to slow upstream services such as Gemini.
+
+HedgedCaller runs a blocking call with an overall timeout. If the call has not answered by
+a percentile of recently observed latencies, a duplicate "hedged" call is sent and whichever
+answers first wins. A CircuitBreaker in front of it fails fast once the recent error rate or
+slow call rate crosses a threshold, instead of letting requests pile up behind a bad upstream.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
+
+
+class ServiceUnavailableError(Exception):
+    """Raised when an upstream call is rejected by the circuit breaker or times out."""
+
+    def __init__(self, message: str, status_code: int = 503, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker over a rolling window of recent calls.
+
+    The breaker opens when at least min_calls are in the window and either the failure rate
+    or the rate of calls slower than slow_call_seconds reaches its threshold. After cooldown
+    seconds a single probe call is let through; its outcome closes or re-opens the breaker.
+
+    allow_request() returns a token that must be passed back to record(). Every state change
+    starts a new generation, and outcomes of calls admitted in an earlier generation (such as a
+    slow call that finishes after the breaker already tripped) are ignored.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, error_rate: float = 0.5,
+                 slow_call_seconds: float = 20.0, slow_call_rate: float = 0.5, cooldown: float = 30.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._calls = deque(maxlen=window)  # (succeeded, was_slow) per call
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> Optional[int]:
+        """Token to pass to record() if the call may go ahead, None if it is rejected."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return self._generation
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return self._generation
+            return None
+
+    def record(self, succeeded: bool, latency: float, token: int):
+        with self._lock:
+            if token != self._generation:
+                return  # Admitted before the last state change, its outcome says nothing about now
+
+            if self.state == self.HALF_OPEN:
+                # Only the probe is admitted in this generation
+                self._probe_in_flight = False
+                if succeeded and latency < self.slow_call_seconds:
+                    self._set_state(self.CLOSED)
+                else:
+                    self._trip()
+                return
+
+            self._calls.append((succeeded, latency >= self.slow_call_seconds))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for succeeded, _ in self._calls if not succeeded)
+            slow_calls = sum(1 for _, slow in self._calls if slow)
+            if failures / len(self._calls) >= self.error_rate or slow_calls / len(self._calls) >= self.slow_call_rate:
+                self._trip()
+
+    def retry_after(self) -> int:
+        """Seconds until the breaker will let a probe call through."""
+        return max(1, int(self.cooldown - (time.monotonic() - self._opened_at)))
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "recent_calls": len(self._calls),
+                "recent_failures": sum(1 for succeeded, _ in self._calls if not succeeded),
+                "recent_slow_calls": sum(1 for _, slow in self._calls if slow),
+            }
+
+    def _trip(self):
+        print(f"⚠️ Circuit breaker '{self.name}' opened")
+        self._set_state(self.OPEN)
+        self._opened_at = time.monotonic()
+
+    def _set_state(self, state: str):
+        self.state = state
+        self._generation += 1
+        self._calls.clear()
+
+
+class HedgedCaller:
+    """Runs blocking calls with a timeout, a hedged duplicate for slow calls and a circuit breaker."""
+
+    def __init__(self, name: str, breaker: CircuitBreaker, timeout: float = 60.0, hedge_percentile: float = 95.0,
+                 default_hedge_delay: float = 10.0, min_hedge_delay: float = 1.0, min_samples: int = 20,
+                 max_workers: int = 16):
+        self.name = name
+        self.breaker = breaker
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.hedged_calls = 0
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._latencies = deque(maxlen=200)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-call")
+
+    def hedge_delay(self) -> float:
+        """Latency percentile of recent successful calls, or the default until enough are seen."""
+        latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.default_hedge_delay
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))
+        return max(self.min_hedge_delay, latencies[index])
+
+    def call(self, fn, *args, **kwargs):
+        token = self.breaker.allow_request()
+        if token is None:
+            raise ServiceUnavailableError(
+                f"{self.name} is temporarily unavailable (circuit open), please retry later",
+                status_code=503, retry_after=self.breaker.retry_after()
+            )
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        hedge_at = start + self.hedge_delay()
+        hedge_decided = False
+        last_error = None
+        pending = {self._submit(fn, *args, **kwargs)}
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_until = deadline if hedge_decided else min(hedge_at, deadline)
+            done, pending = wait(pending, timeout=wait_until - now, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    latency = time.monotonic() - start
+                    self._latencies.append(latency)
+                    self.breaker.record(True, latency, token)
+                    self._cancel(pending)
+                    return future.result()
+                last_error = future.exception()
+
+            if not hedge_decided and pending and time.monotonic() >= hedge_at:
+                hedge_decided = True
+                # Only hedge while healthy, a duplicate would just add load to a struggling upstream,
+                # and only onto an idle worker, a hedge that has to queue cannot win
+                if self.breaker.state == CircuitBreaker.CLOSED and self._in_flight < self.max_workers:
+                    self.hedged_calls += 1
+                    pending.add(self._submit(fn, *args, **kwargs))
+
+        latency = time.monotonic() - start
+        self.breaker.record(False, latency, token)
+        if pending:
+            self._cancel(pending)
+            raise ServiceUnavailableError(f"{self.name} did not respond within {self.timeout:.0f}s", status_code=504)
+        raise last_error
+
+    def _submit(self, fn, *args, **kwargs):
+        """Submit a call to the pool, tracking how many are queued or running."""
+        def run():
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight -= 1
+
+        with self._in_flight_lock:
+            self._in_flight += 1
+        future = self._executor.submit(run)
+        future.add_done_callback(lambda f: self._release_if_cancelled(f))
+        return future
+
+    def _release_if_cancelled(self, future):
+        # A cancelled call never runs, so its in-flight slot is released here instead
+        if future.cancelled():
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+    @staticmethod
+    def _cancel(futures):
+        """
+        Drop losing or abandoned calls that are still queued in the pool. Calls already running
+        cannot be interrupted and finish on their own, bounded by the client's request timeout.
+        """
+        for future in futures:
+            future.cancel()
+
+    def status(self) -> dict:
+        status = self.breaker.status()
+        status.update({
+            "hedge_delay_seconds": round(self.hedge_delay(), 2),
+            "hedged_calls": self.hedged_calls,
+            "timeout_seconds": self.timeout,
+        })
+        return status